@@ -1,10 +1,12 @@
 # core/admin.py
 
 from django.contrib import admin
-from .models import FinancialAssumptions, SolarPanel, WaterPump, Battery, SimulationResult
+from .models import FinancialAssumptions, SolarPanel, WaterPump, Battery, SimulationResult, VolumeDiscount, Portfolio
 
 admin.site.register(FinancialAssumptions)
 admin.site.register(SolarPanel)
 admin.site.register(WaterPump)
 admin.site.register(Battery)
 admin.site.register(SimulationResult)
+admin.site.register(VolumeDiscount)
+admin.site.register(Portfolio)
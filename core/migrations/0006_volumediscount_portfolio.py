@@ -0,0 +1,42 @@
+# Generated by Django 5.2.5 on 2026-10-19 10:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_rename_results_json_simulationresult_simulation_data_json'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VolumeDiscount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('component_type', models.CharField(choices=[('panel', 'Panneau solaire'), ('pump', 'Pompe'), ('battery', 'Batterie')], max_length=20)),
+                ('min_quantity', models.IntegerField()),
+                ('discount_percent', models.FloatField()),
+            ],
+            options={
+                'ordering': ['component_type', 'min_quantity'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Portfolio',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='Portefeuille sans nom', max_length=200)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('budget', models.FloatField()),
+                ('portfolio_data_json', models.JSONField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -78,3 +78,28 @@ class Battery(models.Model):
     @property
     def usable_capacity_kwh(self):
         return self.capacity_kwh * (self.dod_percent / 100)
+
+
+class VolumeDiscount(models.Model):
+    COMPONENT_TYPES = [('panel', 'Panneau solaire'), ('pump', 'Pompe'), ('battery', 'Batterie')]
+    component_type = models.CharField(max_length=20, choices=COMPONENT_TYPES)
+    min_quantity = models.IntegerField() # Quantité totale commandée à partir de laquelle la remise s'applique
+    discount_percent = models.FloatField()
+    def __str__(self):
+        return f"-{self.discount_percent}% sur {self.get_component_type_display()} dès {self.min_quantity} unités"
+
+    class Meta:
+        ordering = ['component_type', 'min_quantity']
+
+
+class Portfolio(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    name = models.CharField(max_length=200, default='Portefeuille sans nom')
+    created_at = models.DateTimeField(auto_now_add=True)
+    budget = models.FloatField()
+    portfolio_data_json = models.JSONField()
+    def __str__(self):
+        return f"{self.name} par {self.user.username}"
+
+    class Meta:
+        ordering = ['-created_at']
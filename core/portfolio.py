@@ -0,0 +1,310 @@
+# core/portfolio.py
+#
+# Dimensionnement d'un portefeuille de sites de pompage sous un budget commun.
+# Ce module ne dépend pas de l'ORM : il travaille sur un instantané du catalogue
+# (dictionnaires simples) lu une seule fois par requête.
+
+import math
+
+RHO, G, ETA_POMPE, PERTES_SYSTEME = 1000, 9.81, 0.4, 0.75
+PERFORMANCE_MARGIN = 1.15
+PUMP_POWER_RATIO = 0.8
+OPTIMIZATION_TARGETS = ('budget', 'performance')
+
+# Nombre maximal de réallocations après application des remises sur volume.
+MAX_DISCOUNT_ROUNDS = 5
+BUDGET_TOLERANCE = 1e-6
+
+
+def _select_components(catalog, puissance_pompe_kw, optimization_target):
+    """Même règle de choix que calculate_api, appliquée à l'instantané du catalogue."""
+    panels, pumps = catalog['panels'], catalog['pumps']
+    eligible_pumps = [p for p in pumps if p['power_kw'] >= puissance_pompe_kw]
+    cheapest_pump = min(eligible_pumps, key=lambda p: p['cost'], default=None)
+    if optimization_target == 'budget':
+        best_panel = min((p for p in panels if p['power_watt'] > 250), key=lambda p: p['cost'], default=None)
+        best_pump = cheapest_pump
+    else:
+        best_panel = max(panels, key=lambda p: (p['efficiency'], p['power_watt']), default=None)
+        best_pump = min(eligible_pumps, key=lambda p: p['power_kw'], default=None) or cheapest_pump
+    return best_panel, best_pump
+
+
+def size_site(site, irradiation_kwh_m2_jour, catalog, optimization_target):
+    """Dimensionne un site pour une cible donnée. Retourne None si le catalogue ne permet pas de l'équiper."""
+    volume_eau_m3, hmt_m, autonomy_days = site['volume'], site['hmt'], site['autonomy_days']
+    energie_electrique_kwh = RHO * G * volume_eau_m3 * hmt_m / ETA_POMPE / (3.6 * 1e6)
+    if irradiation_kwh_m2_jour <= 0 or energie_electrique_kwh <= 0:
+        return None
+
+    battery, number_of_batteries, energy_for_battery_charge = catalog['battery'], 0, 0
+    if autonomy_days > 0:
+        if not battery or battery['usable_capacity_kwh'] <= 0:
+            return None
+        number_of_batteries = math.ceil(energie_electrique_kwh * autonomy_days / battery['usable_capacity_kwh'])
+        energy_for_battery_charge = energie_electrique_kwh / (battery['efficiency'] / 100)
+
+    total_daily_generation_kwh = energie_electrique_kwh + energy_for_battery_charge
+    if optimization_target == 'performance': total_daily_generation_kwh *= PERFORMANCE_MARGIN
+    puissance_crete_kwc = total_daily_generation_kwh / (irradiation_kwh_m2_jour * PERTES_SYSTEME)
+    puissance_pompe_kw = puissance_crete_kwc * PUMP_POWER_RATIO
+
+    best_panel, best_pump = _select_components(catalog, puissance_pompe_kw, optimization_target)
+    if not best_panel or not best_pump or best_panel['power_watt'] <= 0:
+        return None
+    number_of_panels = math.ceil(puissance_crete_kwc * 1000 / best_panel['power_watt'])
+
+    battery_cost = number_of_batteries * battery['cost'] if number_of_batteries else 0
+    material_cost = number_of_panels * best_panel['cost'] + best_pump['cost'] + battery_cost
+    installation_cost = material_cost * (catalog['assumptions']['installation_fees_percent'] / 100)
+
+    # Volume pompable chaque jour avec la puissance installée (arrondie au panneau près), une fois la
+    # recharge des batteries déduite. L'eau livrée est plafonnée au besoin du site : un surplus ne compte pas.
+    installed_kwc = number_of_panels * best_panel['power_watt'] / 1000
+    usable_daily_kwh = max(0, installed_kwc * irradiation_kwh_m2_jour * PERTES_SYSTEME - energy_for_battery_charge)
+    capacity_m3_day = usable_daily_kwh * volume_eau_m3 / energie_electrique_kwh
+
+    components = [('panel', best_panel['id'], number_of_panels), ('pump', best_pump['id'], 1)]
+    component_data = { 'panel_model': f"{best_panel['brand']} {best_panel['model_name']}", 'panel_power_watt': best_panel['power_watt'], 'panel_quantity': number_of_panels, 'pump_model': f"{best_pump['brand']} {best_pump['model_name']}", 'pump_power_kw': best_pump['power_kw'] }
+    if number_of_batteries:
+        components.append(('battery', battery['id'], number_of_batteries))
+        component_data.update({ 'battery_model': f"{battery['brand']} {battery['model_name']}", 'battery_quantity': number_of_batteries })
+
+    return {
+        'optimization_target': optimization_target,
+        # Coûts non arrondis : l'allocation les additionne, l'arrondi se fait à l'affichage.
+        'cost': material_cost + installation_cost,
+        'material_cost': material_cost,
+        'installation_cost': installation_cost,
+        'water_m3_day': round(min(capacity_m3_day, volume_eau_m3), 2),
+        'capacity_m3_day': round(capacity_m3_day, 2),
+        'puissance_requise_kwc': round(puissance_crete_kwc, 2),
+        'puissance_pompe_kw': round(puissance_pompe_kw, 2),
+        'energie_journaliere_kwh': round(energie_electrique_kwh, 2),
+        'component_data': component_data,
+        'components': components,
+    }
+
+
+def plan_sites(sites, catalog):
+    """Options (une par cible réalisable) pour chaque site d'un lot."""
+    return [
+        [plan for target in OPTIMIZATION_TARGETS
+         if (plan := size_site(site, site['irradiation'], catalog, target)) is not None]
+        for site in sites
+    ]
+
+
+def _greedy_allocation(site_options, budget):
+    """Glouton sur l'enveloppe convexe (coût, eau) des options de chaque site, par rendement décroissant."""
+    increments = []
+    for site_index, options in enumerate(site_options):
+        # Enveloppe convexe supérieure des points (coût, eau), en partant de "ne rien installer".
+        points = sorted(((o['cost'], o['water_m3_day'], i) for i, o in enumerate(options)), key=lambda p: (p[0], -p[1]))
+        hull = [(0, 0, None)]
+        for point in points:
+            if point[1] <= hull[-1][1]:
+                continue
+            while len(hull) > 1:
+                (c0, w0, _), (c1, w1, _) = hull[-2], hull[-1]
+                if (w1 - w0) * (point[0] - c0) <= (point[1] - w0) * (c1 - c0):
+                    hull.pop()
+                else:
+                    break
+            hull.append(point)
+        for step, (prev, cur) in enumerate(zip(hull, hull[1:])):
+            delta_cost, delta_water = cur[0] - prev[0], cur[1] - prev[1]
+            ratio = delta_water / delta_cost if delta_cost > 0 else math.inf
+            increments.append((ratio, site_index, step, delta_cost, cur[2]))
+
+    increments.sort(key=lambda inc: (-inc[0], inc[1], inc[2]))
+    selection = [None] * len(site_options)
+    next_step = [0] * len(site_options)
+    remaining = budget
+    for ratio, site_index, step, delta_cost, option_index in increments:
+        # Une amélioration n'est possible que si l'étape précédente du même site a été retenue.
+        if step != next_step[site_index] or delta_cost > remaining:
+            continue
+        remaining -= delta_cost
+        selection[site_index] = option_index
+        next_step[site_index] += 1
+    return selection
+
+
+def _refill(site_options, selection, budget):
+    """Dépense le budget restant : ajoute ou améliore, tant que possible, le site qui gagne le plus d'eau."""
+    remaining = budget - sum(options[choice]['cost'] for options, choice in zip(site_options, selection) if choice is not None)
+    while True:
+        best = None
+        for site_index, options in enumerate(site_options):
+            choice = selection[site_index]
+            current_cost, current_water = (options[choice]['cost'], options[choice]['water_m3_day']) if choice is not None else (0, 0)
+            for option_index, option in enumerate(options):
+                gain, extra_cost = option['water_m3_day'] - current_water, option['cost'] - current_cost
+                if gain > 0 and extra_cost <= remaining and (best is None or (gain, -extra_cost) > best[0]):
+                    best = ((gain, -extra_cost), site_index, option_index, extra_cost)
+        if best is None:
+            return selection
+        _, site_index, option_index, extra_cost = best
+        selection[site_index] = option_index
+        remaining -= extra_cost
+
+
+def total_water(site_options, selection):
+    return sum(options[choice]['water_m3_day'] for options, choice in zip(site_options, selection) if choice is not None)
+
+
+def allocate_budget(site_options, budget):
+    """
+    Choisit au plus une option par site pour maximiser l'eau livrée sans dépasser le budget
+    (sac à dos à choix multiples). Le glouton est complété avec le budget restant, puis comparé à la
+    meilleure option isolée qui tient dans le budget : le résultat vaut au moins la moitié de l'optimum,
+    et l'écart ne dépasse pas l'eau d'un seul site.
+    Retourne l'indice de l'option retenue pour chaque site, ou None si le site n'est pas financé.
+    """
+    selection = _refill(site_options, _greedy_allocation(site_options, budget), budget)
+
+    best_single = max(
+        ((option['water_m3_day'], -option['cost'], site_index, option_index)
+         for site_index, options in enumerate(site_options)
+         for option_index, option in enumerate(options) if option['cost'] <= budget),
+        default=None,
+    )
+    if best_single and best_single[0] > total_water(site_options, selection):
+        single = [None] * len(site_options)
+        single[best_single[2]] = best_single[3]
+        selection = _refill(site_options, single, budget)
+    return selection
+
+
+def discount_percent_for(discounts, component_type, quantity):
+    """Meilleure remise applicable pour une quantité commandée d'un type de composant."""
+    return max((d['discount_percent'] for d in discounts
+                if d['component_type'] == component_type and quantity >= d['min_quantity']), default=0)
+
+
+def _components_by_id(catalog):
+    return {
+        'panel': {p['id']: p for p in catalog['panels']},
+        'pump': {p['id']: p for p in catalog['pumps']},
+        'battery': {catalog['battery']['id']: catalog['battery']} if catalog['battery'] else {},
+    }
+
+
+def _discount_rates(plans, catalog):
+    """Remise applicable à chaque type de composant ; le volume se compte tous modèles confondus."""
+    type_totals = {}
+    for plan in plans:
+        for component_type, _, quantity in plan['components']:
+            type_totals[component_type] = type_totals.get(component_type, 0) + quantity
+    return {component_type: discount_percent_for(catalog['discounts'], component_type, quantity)
+            for component_type, quantity in type_totals.items()}
+
+
+def price_plan(plan, catalog, discount_rates):
+    """Coûts non arrondis d'une option : matériel remisé, installation calculée sur ce matériel, total."""
+    by_id = _components_by_id(catalog)
+    material_cost = sum(quantity * by_id[component_type][component_id]['cost'] * (1 - discount_rates.get(component_type, 0) / 100)
+                        for component_type, component_id, quantity in plan['components'])
+    installation_cost = material_cost * (catalog['assumptions']['installation_fees_percent'] / 100)
+    return {'material_cost': material_cost, 'installation_cost': installation_cost, 'cost': material_cost + installation_cost}
+
+
+def _selected_plans(site_options, selection):
+    return [options[choice] for options, choice in zip(site_options, selection) if choice is not None]
+
+
+def _total_investment(plans, catalog):
+    discount_rates = _discount_rates(plans, catalog)
+    return sum(price_plan(plan, catalog, discount_rates)['cost'] for plan in plans)
+
+
+def _within_budget(total, budget):
+    # Tolérance minime : deux sommes flottantes des mêmes montants peuvent différer de quelques ulp.
+    return total <= budget + BUDGET_TOLERANCE
+
+
+def _fit_to_budget(site_options, selection, catalog, budget):
+    """Retire les sites au plus faible rendement (eau par euro) jusqu'à ce que le coût réel tienne dans le budget."""
+    selection = list(selection)
+    while not _within_budget(_total_investment(_selected_plans(site_options, selection), catalog), budget):
+        funded = [i for i, choice in enumerate(selection) if choice is not None]
+        drop = min(funded, key=lambda i: (site_options[i][selection[i]]['water_m3_day'] / site_options[i][selection[i]]['cost']
+                                          if site_options[i][selection[i]]['cost'] > 0 else math.inf, i))
+        selection[drop] = None
+    return selection
+
+
+def build_bill_of_materials(plans, catalog):
+    """Nomenclature agrégée du portefeuille, avec remises sur volume appliquées par ligne."""
+    quantities = {}
+    for plan in plans:
+        for component_type, component_id, quantity in plan['components']:
+            key = (component_type, component_id)
+            quantities[key] = quantities.get(key, 0) + quantity
+
+    by_id = _components_by_id(catalog)
+    discount_rates = _discount_rates(plans, catalog)
+    lines = []
+    for (component_type, component_id), quantity in sorted(quantities.items()):
+        component = by_id[component_type][component_id]
+        discount = discount_rates[component_type]
+        list_total = quantity * component['cost']
+        lines.append({
+            'component_type': component_type,
+            'model': f"{component['brand']} {component['model_name']}",
+            'quantity': quantity,
+            'unit_cost': component['cost'],
+            'list_total': round(list_total, 2),
+            'discount_percent': discount,
+            'total': round(list_total * (1 - discount / 100), 2),
+        })
+    return lines
+
+
+def summarise_portfolio(site_options, selection, catalog, budget):
+    """Nomenclature, remises et totaux du portefeuille ; les totaux sont calculés sans arrondi puis arrondis à la fin."""
+    plans = _selected_plans(site_options, selection)
+    discount_rates = _discount_rates(plans, catalog)
+    prices = [price_plan(plan, catalog, discount_rates) for plan in plans]
+    list_material_cost = sum(price_plan(plan, catalog, {})['material_cost'] for plan in plans)
+    material_cost = sum(price['material_cost'] for price in prices)
+    installation_cost = sum(price['installation_cost'] for price in prices)
+    total_investment = sum(price['cost'] for price in prices)
+    return {
+        'bill_of_materials': build_bill_of_materials(plans, catalog),
+        'discount_rates': discount_rates,
+        'totals': {
+            'sites_funded': len(plans),
+            'sites_total': len(site_options),
+            'water_m3_day': round(total_water(site_options, selection), 2),
+            'list_material_cost': round(list_material_cost, 2),
+            'volume_discount': round(list_material_cost - material_cost, 2),
+            'material_cost': round(material_cost, 2),
+            'installation_cost': round(installation_cost, 2),
+            'total_investment': round(total_investment, 2),
+            # "+ 0.0" évite d'afficher -0.0 quand le budget est dépensé au centime près.
+            'budget_remaining': round(budget - total_investment, 2) + 0.0,
+        },
+    }
+
+
+def optimise_portfolio(site_options, budget, catalog):
+    """
+    Alloue le budget aux prix catalogue, puis réalloue aux prix remisés pour dépenser l'économie
+    des remises sur volume, jusqu'à ce que la sélection ne change plus. Chaque sélection est ramenée
+    dans le budget sur son coût réel (remises comprises) avant d'être retenue.
+    Retourne (sélection, résumé du portefeuille).
+    """
+    selection = _fit_to_budget(site_options, allocate_budget(site_options, budget), catalog, budget)
+    for _ in range(MAX_DISCOUNT_ROUNDS):
+        discount_rates = _discount_rates(_selected_plans(site_options, selection), catalog)
+        if not any(discount_rates.values()):
+            break
+        priced_options = [[{'cost': price_plan(option, catalog, discount_rates)['cost'], 'water_m3_day': option['water_m3_day']} for option in options]
+                          for options in site_options]
+        candidate = _fit_to_budget(site_options, allocate_budget(priced_options, budget), catalog, budget)
+        if candidate == selection or total_water(site_options, candidate) <= total_water(site_options, selection):
+            break
+        selection = candidate
+    return selection, summarise_portfolio(site_options, selection, catalog, budget)
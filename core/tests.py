@@ -1,3 +1,313 @@
-from django.test import TestCase
+import json
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+
+from .models import SimulationResult, FinancialAssumptions, SolarPanel, WaterPump, VolumeDiscount, Portfolio
+from .portfolio import allocate_budget, build_bill_of_materials, optimise_portfolio, plan_sites, size_site
+
+
+def pvgis_hourly_response(days=2):
+    """Réponse PVGIS 'seriescalc' factice : 1 kW par kWc à midi, rien le reste de la journée."""
+    hourly = [
+        {'time': f"202001{day + 1:02d}:{hour:02d}10", 'P': 1000 if hour == 12 else 0}
+        for day in range(days) for hour in range(24)
+    ]
+    response = mock.Mock()
+    response.json.return_value = {'outputs': {'hourly': hourly}}
+    return response
+
+
+class HourlyProductionCurveApiTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_user('alice', password='secret'))
+        self.url = reverse('hourly_production_curve_api')
+        patcher = mock.patch('core.views.requests.get', return_value=pvgis_hourly_response())
+        self.pvgis_get = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_login_is_required(self):
+        self.client.logout()
+        response = self.client.get(f"{self.url}?kwc=3.00&lat=6.5000&lon=2.1000")
+        self.assertEqual(response.status_code, 302)
+        self.pvgis_get.assert_not_called()
+
+    def test_non_canonical_query_redirects_to_canonical_url(self):
+        response = self.client.get(self.url, {'lat': '6.5', 'lon': '2.1', 'kwc': '3'})
+        self.assertEqual(response.status_code, 301)
+        self.assertEqual(response['Location'], f"{self.url}?kwc=3.00&lat=6.5000&lon=2.1000")
+        self.assertFalse(response.has_header('ETag'))
+        self.pvgis_get.assert_not_called()
+
+    def test_canonical_query_returns_privately_cacheable_curve(self):
+        response = self.client.get(f"{self.url}?kwc=3.00&lat=6.5000&lon=2.1000")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[12], 3.0)
+        self.assertTrue(response.has_header('ETag'))
+        self.assertIn('private', response['Cache-Control'])
+        self.assertNotIn('public', response['Cache-Control'])
+
+    def test_matching_if_none_match_returns_304_without_calling_pvgis(self):
+        url = f"{self.url}?kwc=3.00&lat=6.5000&lon=2.1000"
+        etag = self.client.get(url)['ETag']
+        self.pvgis_get.reset_mock()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.pvgis_get.assert_not_called()
+
+    def test_profile_is_fetched_once_per_location_whatever_the_peak_power(self):
+        first = self.client.get(f"{self.url}?kwc=3.00&lat=6.5000&lon=2.1000")
+        second = self.client.get(f"{self.url}?kwc=7.50&lat=6.5000&lon=2.1000")
+        self.assertEqual(self.pvgis_get.call_count, 1)
+        self.assertEqual((first.json()[12], second.json()[12]), (3.0, 7.5))
+        self.assertNotEqual(first['ETag'], second['ETag'])
+
+    def test_fallback_curve_is_not_cached(self):
+        self.pvgis_get.side_effect = requests.exceptions.ConnectionError("PVGIS indisponible")
+
+        response = self.client.get(f"{self.url}?kwc=3.00&lat=6.5000&lon=2.1000")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertIn('no-store', response['Cache-Control'])
+
+        self.pvgis_get.side_effect = None
+        self.client.get(f"{self.url}?kwc=3.00&lat=6.5000&lon=2.1000")
+        self.assertEqual(self.pvgis_get.call_count, 2)
+
+    def test_invalid_parameters_are_rejected(self):
+        for query in ({'lat': 'nan', 'lon': '2', 'kwc': '3'}, {'lat': '95', 'lon': '2', 'kwc': '3'},
+                      {'lat': '6', 'lon': '2', 'kwc': 'inf'}, {'lat': '6', 'lon': '2'}):
+            with self.subTest(query=query):
+                self.assertEqual(self.client.get(self.url, query).status_code, 400)
+        self.pvgis_get.assert_not_called()
+
+
+class HistoryApiConditionalTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        self.client.force_login(self.user)
+        self.url = reverse('history_api')
+
+    def create_simulation(self, name):
+        return SimulationResult.objects.create(
+            user=self.user, name=name, latitude=6.5, longitude=2.1, volume_eau=20, hmt=30,
+            simulation_data_json={'inputs': {'name': name}, 'results': {}}
+        )
+
+    def test_unchanged_history_returns_304(self):
+        self.create_simulation('Puits A')
+        etag = self.client.get(self.url)['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_new_simulation_changes_etag(self):
+        self.create_simulation('Puits A')
+        etag = self.client.get(self.url)['ETag']
+        self.create_simulation('Puits B')
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.json()), 2)
+
+
+def catalog_snapshot(discounts=()):
+    return {
+        'panels': [
+            {'id': 1, 'brand': 'Sun', 'model_name': 'P400', 'power_watt': 400, 'efficiency': 21, 'cost': 120},
+            {'id': 2, 'brand': 'Sun', 'model_name': 'P300', 'power_watt': 300, 'efficiency': 18, 'cost': 80},
+        ],
+        'pumps': [
+            {'id': i, 'brand': 'Aqua', 'model_name': f"M{i}", 'power_kw': power_kw, 'cost': power_kw * 400}
+            for i, power_kw in enumerate([0.5, 1, 2, 4, 8], 1)
+        ],
+        'battery': None,
+        'assumptions': {'installation_fees_percent': 10},
+        'discounts': list(discounts),
+    }
+
+
+def site(volume=20, hmt=30, irradiation=5.0):
+    return {'volume': volume, 'hmt': hmt, 'autonomy_days': 0, 'irradiation': irradiation}
+
+
+class SizeSiteTests(SimpleTestCase):
+    def test_delivered_water_is_capped_at_demand(self):
+        catalog = catalog_snapshot()
+        budget = size_site(site(), 5.0, catalog, 'budget')
+        performance = size_site(site(), 5.0, catalog, 'performance')
+
+        self.assertEqual(budget['water_m3_day'], 20)
+        self.assertEqual(performance['water_m3_day'], 20)
+        self.assertGreater(performance['capacity_m3_day'], budget['capacity_m3_day'])
+
+    def test_site_without_suitable_pump_is_infeasible(self):
+        self.assertEqual(plan_sites([site(volume=2000, hmt=80)], catalog_snapshot()), [[]])
+
+
+class AllocateBudgetTests(SimpleTestCase):
+    def test_best_single_option_beats_poor_greedy_start(self):
+        options = [[{'cost': 1, 'water_m3_day': 2}], [{'cost': 100, 'water_m3_day': 150}]]
+        self.assertEqual(allocate_budget(options, 100), [None, 0])
+
+    def test_leftover_budget_is_refilled(self):
+        # Le glouton prend le site 0 (meilleur rendement) puis ne peut plus passer au palier suivant ;
+        # le reste du budget doit financer le site 1.
+        options = [
+            [{'cost': 10, 'water_m3_day': 10}, {'cost': 100, 'water_m3_day': 60}],
+            [{'cost': 40, 'water_m3_day': 20}],
+        ]
+        self.assertEqual(allocate_budget(options, 60), [0, 0])
+
+    def test_dominated_option_is_never_chosen(self):
+        options = [[{'cost': 10, 'water_m3_day': 20}, {'cost': 12, 'water_m3_day': 20}]]
+        self.assertEqual(allocate_budget(options, 100), [0])
+
+    def test_empty_budget_and_infeasible_sites(self):
+        options = [[{'cost': 10, 'water_m3_day': 20}], []]
+        self.assertEqual(allocate_budget(options, 5), [None, None])
+
+    def test_matches_exhaustive_search_on_small_portfolios(self):
+        from itertools import product
+        import random
+        rng = random.Random(4)
+        for _ in range(30):
+            options = [
+                sorted(({'cost': rng.randint(5, 60), 'water_m3_day': rng.randint(1, 40)} for _ in range(rng.randint(0, 2))),
+                       key=lambda o: o['cost'])
+                for _ in range(6)
+            ]
+            budget = rng.randint(20, 150)
+            best = 0
+            for combo in product(*[[None] + list(range(len(o))) for o in options]):
+                chosen = [options[i][k] for i, k in enumerate(combo) if k is not None]
+                if sum(o['cost'] for o in chosen) <= budget:
+                    best = max(best, sum(o['water_m3_day'] for o in chosen))
+            selection = allocate_budget(options, budget)
+            chosen = [options[i][k] for i, k in enumerate(selection) if k is not None]
+            self.assertLessEqual(sum(o['cost'] for o in chosen), budget)
+            self.assertGreaterEqual(sum(o['water_m3_day'] for o in chosen), best / 2)
+
+
+class VolumeDiscountTests(SimpleTestCase):
+    def plans(self, count):
+        return [{'components': [('panel', 1, 10), ('pump', 2, 1)]}] * count
+
+    def test_best_reached_tier_applies_per_component_type(self):
+        discounts = [
+            {'component_type': 'panel', 'min_quantity': 20, 'discount_percent': 5},
+            {'component_type': 'panel', 'min_quantity': 30, 'discount_percent': 10},
+            {'component_type': 'pump', 'min_quantity': 10, 'discount_percent': 20},
+        ]
+        lines = build_bill_of_materials(self.plans(3), catalog_snapshot(discounts))
+        panel, pump = lines
+        self.assertEqual((panel['quantity'], panel['discount_percent'], panel['total']), (30, 10, 3240))
+        self.assertEqual((pump['quantity'], pump['discount_percent'], pump['total']), (3, 0, 1200))
+
+    def test_discount_savings_fund_more_sites_and_installation_uses_discounted_material(self):
+        catalog = catalog_snapshot([
+            {'component_type': 'panel', 'min_quantity': 3, 'discount_percent': 50},
+            {'component_type': 'pump', 'min_quantity': 3, 'discount_percent': 50},
+        ])
+        site_options = plan_sites([site(volume=5, hmt=20) for _ in range(4)], catalog)
+        single_cost = site_options[0][0]['cost']
+
+        selection, summary = optimise_portfolio(site_options, single_cost * 3, catalog)
+        totals = summary['totals']
+        self.assertEqual(totals['sites_funded'], 4)
+        self.assertLessEqual(totals['total_investment'], single_cost * 3)
+        self.assertAlmostEqual(totals['installation_cost'], totals['material_cost'] * 0.1, places=1)
+
+
+class PortfolioApiTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        self.client.force_login(self.user)
+        self.url = reverse('portfolio_api')
+        cache.clear()
+        FinancialAssumptions.objects.create()
+        SolarPanel.objects.create(brand='Sun', model_name='P400', power_watt=400, efficiency=21, cost=120)
+        WaterPump.objects.create(brand='Aqua', model_name='M2', power_kw=2, max_flow_rate_m3_h=10, max_hmt=60, cost=800)
+        patcher = mock.patch('core.views.get_solar_irradiation', return_value=(5.0, True))
+        self.irradiation = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, body):
+        return self.client.post(self.url, body, content_type='application/json')
+
+    def test_portfolio_is_sized_and_saved(self):
+        sites = [{'name': f"Puits {i}", 'lat': 6.5, 'lon': 2.1 + i / 100, 'volume': 10, 'hmt': 20} for i in range(3)]
+        response = self.post(json.dumps({'budget': 1e6, 'sites': sites}))
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['totals']['sites_funded'], 3)
+        self.assertEqual(data['totals']['water_m3_day'], 30)
+        self.assertTrue(all(s['status'] == 'funded' for s in data['sites']))
+
+    def sites(self, count):
+        return [{'name': f"Puits {i}", 'lat': 6.5, 'lon': 2.0 + i / 100, 'volume': 10, 'hmt': 20} for i in range(count)]
+
+    def test_mostly_offline_irradiation_is_rejected_and_not_saved(self):
+        self.irradiation.return_value = (5.0, False)
+        response = self.post(json.dumps({'budget': 1e6, 'sites': self.sites(5)}))
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(response.has_header('Retry-After'))
+        self.assertEqual(response.json()['sites_pvgis_offline'], 5)
+        self.assertFalse(Portfolio.objects.exists())
+
+    def test_few_offline_sites_make_the_portfolio_provisional(self):
+        self.irradiation.side_effect = lambda lat, lon: (5.0, round(lon, 2) != 2.0)
+        data = self.post(json.dumps({'budget': 1e6, 'sites': self.sites(10)})).json()
+        self.assertEqual(data['totals']['sites_pvgis_offline'], 1)
+        self.assertTrue(data['provisional'])
+
+    def test_site_costs_use_discounted_prices_and_add_up_to_total(self):
+        VolumeDiscount.objects.create(component_type='panel', min_quantity=2, discount_percent=10)
+        VolumeDiscount.objects.create(component_type='pump', min_quantity=2, discount_percent=5)
+        data = self.post(json.dumps({'budget': 1e6, 'sites': self.sites(4)})).json()
+        plans = [s['plan'] for s in data['sites']]
+
+        self.assertFalse(data['provisional'])
+        self.assertTrue(all(plan['cost'] < plan['list_cost'] for plan in plans))
+        self.assertAlmostEqual(sum(plan['cost'] for plan in plans), data['totals']['total_investment'], delta=0.01 * len(plans))
+
+    def test_non_finite_or_out_of_range_inputs_are_rejected(self):
+        valid_site = {'lat': 6.5, 'lon': 2.1, 'volume': 10, 'hmt': 20}
+        bodies = [
+            '{"budget": NaN, "sites": [{"lat": 6.5, "lon": 2.1, "volume": 10, "hmt": 20}]}',
+            '{"budget": Infinity, "sites": [{"lat": 6.5, "lon": 2.1, "volume": 10, "hmt": 20}]}',
+            '{"budget": 1000, "sites": [{"lat": 6.5, "lon": 2.1, "volume": NaN, "hmt": 20}]}',
+            json.dumps({'budget': 1000, 'sites': [dict(valid_site, lat=120)]}),
+            json.dumps({'budget': -5, 'sites': [valid_site]}),
+            json.dumps({'budget': 1000, 'sites': []}),
+        ]
+        for body in bodies:
+            with self.subTest(body=body):
+                self.assertEqual(self.post(body).status_code, 400)
+
+
+class PortfolioBudgetTests(SimpleTestCase):
+    def test_total_investment_never_exceeds_budget(self):
+        # Prix et frais non ronds : les arrondis au centime des options ne doivent pas faire dépasser le budget.
+        import random
+        catalog = catalog_snapshot([{'component_type': 'panel', 'min_quantity': 40, 'discount_percent': 3.7}])
+        for panel in catalog['panels']: panel['cost'] += 0.333
+        catalog['assumptions']['installation_fees_percent'] = 12.345
+        for seed in range(300):
+            rng = random.Random(seed)
+            sites = [site(volume=rng.uniform(3, 40), hmt=rng.uniform(5, 40)) for _ in range(rng.randint(1, 20))]
+            site_options = plan_sites(sites, catalog)
+            budget = round(sum(options[0]['cost'] for options in site_options if options), 2)
+
+            selection, summary = optimise_portfolio(site_options, budget, catalog)
+            with self.subTest(seed=seed):
+                self.assertLessEqual(summary['totals']['total_investment'], budget)
+                self.assertGreaterEqual(summary['totals']['budget_remaining'], 0)
@@ -8,6 +8,8 @@ urlpatterns = [
     path('signup/', views.SignUpView.as_view(), name='signup'), 
     path('api/calculate', views.calculate_api, name='calculate_api'),
     path('api/generate-report', views.generate_pdf_report, name='generate_report'),
+    path('api/portfolio', views.portfolio_api, name='portfolio_api'),
     path('api/history', views.history_api, name='history_api'),
     path('api/hourly-production', views.hourly_production_api, name='hourly_production_api'), 
+    path('api/hourly-production/curve', views.hourly_production_curve_api, name='hourly_production_curve_api'),
 ]
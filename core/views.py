@@ -1,20 +1,29 @@
 # core/views.py
 
 from django.shortcuts import render, redirect
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, HttpResponsePermanentRedirect
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
+from django.utils.cache import patch_cache_control, add_never_cache_headers, get_conditional_response
+from django.utils.http import quote_etag
+from django.core.cache import cache
 from django.template.loader import render_to_string
 from weasyprint import HTML
 import json
 import requests
 import math
+import hashlib
+import threading
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
-from .models import FinancialAssumptions, SolarPanel, WaterPump, SimulationResult, Battery, User
+from .models import FinancialAssumptions, SolarPanel, WaterPump, SimulationResult, Battery, User, VolumeDiscount, Portfolio
+from .portfolio import RHO, G, ETA_POMPE, PERTES_SYSTEME, plan_sites, optimise_portfolio, price_plan
 from django.contrib.auth.forms import UserCreationForm
 from django.urls import reverse_lazy
 from django.views import generic
-from django.db.models import F, FloatField
+from django.db.models import F, FloatField, Max, Count
 from django.db.models.functions import Cast 
 
 
@@ -28,8 +37,22 @@ def index_view(request):
     return render(request, 'index.html')
 
 
-RHO, G, ETA_POMPE, PERTES_SYSTEME = 1000, 9.81, 0.4, 0.75
 PVGIS_API_BASE_URL = "https://re.jrc.ec.europa.eu/api/"
+DEFAULT_IRRADIATION_KWH_M2 = 5.0
+IRRADIATION_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+PORTFOLIO_MAX_SITES = 1000
+PORTFOLIO_PVGIS_WORKERS = 16
+PORTFOLIO_PVGIS_DEADLINE_S = 20
+# Au-delà de cette part de sites sans irradiation PVGIS, le portefeuille est refusé plutôt que dimensionné sur la valeur par défaut.
+PORTFOLIO_MAX_OFFLINE_SHARE = 0.2
+
+# Version des données servies par les endpoints GET : à incrémenter dès que le calcul
+# de la courbe horaire ou le format de l'historique change, pour invalider les ETags.
+HOURLY_DATA_VERSION = "pvgis-seriescalc-loss14-v1"
+HISTORY_DATA_VERSION = "history-v1"
+HOURLY_CACHE_MAX_AGE = 60 * 60 * 24
+FALLBACK_CURVE = [ 0.00, 0.00, 0.00, 0.00, 0.00, 0.00, 0.05, 0.20, 0.50, 0.80, 0.95, 1.00, 1.00, 0.95, 0.80, 0.50, 0.20, 0.05, 0.00, 0.00, 0.00, 0.00, 0.00, 0.00 ]
 
 def get_solar_irradiation(lat, lon):
     api_url = f"{PVGIS_API_BASE_URL}PVcalc?lat={lat}&lon={lon}&peakpower=1&loss=14&outputformat=json"
@@ -40,7 +63,73 @@ def get_solar_irradiation(lat, lon):
         return data['outputs']['totals']['fixed']['E_d'], True
     except requests.exceptions.RequestException as e:
         print(f"AVERTISSEMENT API PVGIS (journalier): {e}. Utilisation de la valeur par défaut.")
-        return 5.0, False
+        return DEFAULT_IRRADIATION_KWH_M2, False
+
+def _irradiation_cache_key(lat, lon):
+    return f"pvgis:E_d:{float(lat):.4f}:{float(lon):.4f}"
+
+def get_cached_solar_irradiation(lat, lon):
+    """Comme get_solar_irradiation, mais garde en cache les réponses de PVGIS (jamais la valeur par défaut)."""
+    cache_key = _irradiation_cache_key(lat, lon)
+    irradiation = cache.get(cache_key)
+    if irradiation is not None:
+        return irradiation, True
+    irradiation, pvgis_online = get_solar_irradiation(lat, lon)
+    if pvgis_online:
+        cache.set(cache_key, irradiation, IRRADIATION_CACHE_TIMEOUT)
+    return irradiation, pvgis_online
+
+# Pool partagé par toutes les requêtes de portefeuille : les appels PVGIS en dépassement du délai
+# continuent en arrière-plan et remplissent le cache, pour qu'une nouvelle tentative soit rapide.
+_pvgis_executor = ThreadPoolExecutor(max_workers=PORTFOLIO_PVGIS_WORKERS, thread_name_prefix='pvgis')
+_pvgis_in_flight = {}
+_pvgis_in_flight_lock = threading.Lock()
+
+def _submit_irradiation_lookup(coords):
+    # Un seul appel en cours par coordonnées, même si plusieurs requêtes les demandent.
+    with _pvgis_in_flight_lock:
+        future = _pvgis_in_flight.get(coords)
+        if future is None:
+            future = _pvgis_executor.submit(get_cached_solar_irradiation, *coords)
+            _pvgis_in_flight[coords] = future
+            future.add_done_callback(lambda _, coords=coords: _pvgis_in_flight.pop(coords, None))
+    return future
+
+def fetch_portfolio_irradiations(coordinates):
+    """
+    Irradiation de chaque couple (lat, lon) : lue dans le cache, sinon demandée à PVGIS en parallèle.
+    Les sites sans réponse avant PORTFOLIO_PVGIS_DEADLINE_S reçoivent la valeur par défaut
+    (pvgis_online à False) ; leur appel continue en arrière-plan.
+    """
+    results, futures = {}, {}
+    for coords in coordinates:
+        irradiation = cache.get(_irradiation_cache_key(*coords))
+        if irradiation is not None:
+            results[coords] = (irradiation, True)
+        else:
+            futures[coords] = _submit_irradiation_lookup(coords)
+    wait(futures.values(), timeout=PORTFOLIO_PVGIS_DEADLINE_S)
+    for coords, future in futures.items():
+        results[coords] = future.result() if future.done() and not future.exception() else (DEFAULT_IRRADIATION_KWH_M2, False)
+    return results
+
+def build_catalog_snapshot():
+    """Instantané du catalogue, lu une seule fois et partagé par tous les sites du portefeuille."""
+    assumptions = FinancialAssumptions.objects.first()
+    if not assumptions: raise Exception("Hypothèses financières non configurées.")
+    best_battery = Battery.objects.annotate(
+        computed_capacity=Cast(F('voltage') * F('capacity_ah'), output_field=FloatField())
+    ).order_by('-computed_capacity').first()
+    battery_data = None
+    if best_battery:
+        battery_data = { 'id': best_battery.id, 'brand': best_battery.brand, 'model_name': best_battery.model_name, 'cost': best_battery.cost, 'efficiency': best_battery.efficiency, 'usable_capacity_kwh': best_battery.usable_capacity_kwh }
+    return {
+        'panels': list(SolarPanel.objects.values('id', 'brand', 'model_name', 'power_watt', 'efficiency', 'cost')),
+        'pumps': list(WaterPump.objects.values('id', 'brand', 'model_name', 'power_kw', 'cost')),
+        'battery': battery_data,
+        'assumptions': { 'installation_fees_percent': assumptions.installation_fees_percent },
+        'discounts': list(VolumeDiscount.objects.values('component_type', 'min_quantity', 'discount_percent')),
+    }
 
 @login_required
 @csrf_exempt
@@ -61,7 +150,7 @@ def calculate_api(request):
             energie_hydraulique_J = RHO * G * volume_eau_m3 * hmt_m
             energie_electrique_J = energie_hydraulique_J / ETA_POMPE
             energie_electrique_kwh = energie_electrique_J / (3.6 * 1e6)
-            irradiation_kwh_m2_jour, pvgis_online = get_solar_irradiation(lat, lon)
+            irradiation_kwh_m2_jour, pvgis_online = get_cached_solar_irradiation(lat, lon)
 
             
             battery_data, number_of_batteries, best_battery = None, 0, None
@@ -139,51 +228,206 @@ def calculate_api(request):
     
     return JsonResponse({'error': 'Méthode non autorisée'}, status=405)
 
+def _parse_portfolio_site(index, raw_site):
+    site = {
+        'name': str(raw_site.get('name') or f"Site {index + 1}"),
+        'lat': float(raw_site['lat']), 'lon': float(raw_site['lon']),
+        'volume': float(raw_site['volume']), 'hmt': float(raw_site['hmt']),
+        'autonomy_days': float(raw_site.get('autonomy_days', 0)),
+    }
+    # json.loads accepte NaN et Infinity, qui passent les comparaisons ci-dessous sans erreur.
+    if not all(math.isfinite(site[key]) for key in ('lat', 'lon', 'volume', 'hmt', 'autonomy_days')):
+        raise ValueError(f"valeur non finie pour le site {index + 1}")
+    if not (-90 <= site['lat'] <= 90 and -180 <= site['lon'] <= 180):
+        raise ValueError(f"coordonnées invalides pour le site {index + 1}")
+    if site['volume'] <= 0 or site['hmt'] <= 0 or site['autonomy_days'] < 0:
+        raise ValueError(f"volume, hmt ou autonomie invalide pour le site {index + 1}")
+    return site
+
+@login_required
+@csrf_exempt
+def portfolio_api(request):
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            budget = float(data['budget'])
+            raw_sites = data['sites']
+            if not math.isfinite(budget) or budget <= 0: raise ValueError("le budget doit être un nombre positif")
+            if not isinstance(raw_sites, list) or not raw_sites: raise ValueError("aucun site fourni")
+            if len(raw_sites) > PORTFOLIO_MAX_SITES: raise ValueError(f"{PORTFOLIO_MAX_SITES} sites maximum par portefeuille")
+            sites = [_parse_portfolio_site(i, raw_site) for i, raw_site in enumerate(raw_sites)]
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return JsonResponse({'error': f'Données de portefeuille invalides: {e}'}, status=400)
+
+        try:
+            catalog = build_catalog_snapshot()
+            irradiations = fetch_portfolio_irradiations({(round(s['lat'], 4), round(s['lon'], 4)) for s in sites})
+            for site in sites:
+                site['irradiation'], site['pvgis_online'] = irradiations[(round(site['lat'], 4), round(site['lon'], 4))]
+
+            sites_pvgis_offline = sum(1 for site in sites if not site['pvgis_online'])
+            if sites_pvgis_offline > PORTFOLIO_MAX_OFFLINE_SHARE * len(sites):
+                response = JsonResponse({'error': f"Irradiation PVGIS indisponible pour {sites_pvgis_offline} sites sur {len(sites)}. Les données sont en cours de récupération, réessayez dans quelques instants.", 'sites_pvgis_offline': sites_pvgis_offline}, status=503)
+                response['Retry-After'] = str(PORTFOLIO_PVGIS_DEADLINE_S)
+                return response
+
+            site_options = plan_sites(sites, catalog)
+            selection, summary = optimise_portfolio(site_options, budget, catalog)
+
+            site_plans = []
+            for site, options, choice in zip(sites, site_options, selection):
+                plan = options[choice] if choice is not None else None
+                plan_data = None
+                if plan:
+                    # Coûts du site aux prix remisés du portefeuille, pour qu'ils s'additionnent au total.
+                    prices = price_plan(plan, catalog, summary['discount_rates'])
+                    plan_data = {k: v for k, v in plan.items() if k not in ('components', 'cost', 'material_cost', 'installation_cost')}
+                    plan_data.update({
+                        'list_cost': round(plan['cost'], 2), 'cost': round(prices['cost'], 2),
+                        'material_cost': round(prices['material_cost'], 2), 'installation_cost': round(prices['installation_cost'], 2),
+                    })
+                site_plans.append({
+                    'name': site['name'], 'latitude': site['lat'], 'longitude': site['lon'],
+                    'volume_eau': site['volume'], 'hmt': site['hmt'], 'autonomy_days': site['autonomy_days'],
+                    'irradiation_locale_kwh_m2': round(site['irradiation'], 2), 'pvgis_online': site['pvgis_online'],
+                    'status': 'funded' if plan else ('unfunded' if options else 'infeasible'),
+                    'plan': plan_data,
+                })
+
+            totals = dict(summary['totals'], water_demand_m3_day=round(sum(site['volume'] for site in sites), 2), sites_pvgis_offline=sites_pvgis_offline)
+            portfolio_data = {
+                'inputs': { 'name': data.get('portfolio_name', f"Portefeuille de {len(sites)} sites"), 'budget': budget },
+                # Provisoire : une partie des sites a été dimensionnée avec l'irradiation par défaut.
+                'provisional': sites_pvgis_offline > 0,
+                'sites': site_plans, 'bill_of_materials': summary['bill_of_materials'], 'totals': totals,
+            }
+            portfolio = Portfolio.objects.create(
+                user=request.user, name=portfolio_data['inputs']['name'], budget=budget,
+                portfolio_data_json=portfolio_data
+            )
+            portfolio_data['created_at'] = portfolio.created_at.strftime('%d/%m/%Y %H:%M')
+
+            return JsonResponse(portfolio_data)
+
+        except Exception as e:
+            print(f"ERREUR SERVEUR DANS PORTFOLIO_API: {e}")
+            return JsonResponse({'error': f'Une erreur interne est survenue sur le serveur: {e}'}, status=500)
+
+    return JsonResponse({'error': 'Méthode non autorisée'}, status=405)
+
+def get_hourly_profile(lat, lon):
+    """
+    Production moyenne (kW par kWc) heure par heure, et indicateur de disponibilité de PVGIS.
+    Les réponses de PVGIS sont gardées en cache par coordonnées : la puissance crête n'intervient pas dans la requête.
+    """
+    try:
+        cache_key = f"pvgis:hourly:{float(lat):.4f}:{float(lon):.4f}"
+        profile = cache.get(cache_key)
+        if profile is not None:
+            return profile, True
+
+        api_url = f"{PVGIS_API_BASE_URL}seriescalc?lat={lat}&lon={lon}&pvcalculation=1&loss=14&outputformat=json"
+
+        response = requests.get(api_url, timeout=5)
+        response.raise_for_status()
+        pvgis_data = response.json()
+
+        if 'hourly' not in pvgis_data.get('outputs', {}): raise ValueError("La réponse de l'API PVGIS ne contient pas de données horaires.")
+
+        hourly_data = pvgis_data['outputs']['hourly']
+        avg_hourly_production_w_per_kwc = [0] * 24
+        num_days = len(hourly_data) / 24
+        if num_days < 1: raise ValueError("Données horaires insuffisantes.")
+
+        for record in hourly_data:
+            hour_of_day = int(record['time'][9:11])
+            avg_hourly_production_w_per_kwc[hour_of_day] += record['P']
+
+        profile = [(s / num_days) / 1000 for s in avg_hourly_production_w_per_kwc]
+        cache.set(cache_key, profile, IRRADIATION_CACHE_TIMEOUT)
+        return profile, True
+
+    except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+        print(f"AVERTISSEMENT API PVGIS (horaire): {e}. Utilisation de la courbe de secours.")
+        return FALLBACK_CURVE, False
+
+def compute_hourly_production(lat, lon, peak_power_kwc):
+    """Courbe de production moyenne (kW) heure par heure, et indicateur de disponibilité de PVGIS."""
+    profile, pvgis_online = get_hourly_profile(lat, lon)
+    return [round(val * peak_power_kwc, 2) for val in profile], pvgis_online
+
+def canonical_hourly_params(query):
+    """Paramètres (kwc, lat, lon) normalisés et triés, ou None s'ils sont absents ou invalides."""
+    try:
+        lat, lon, kwc = float(query['lat']), float(query['lon']), float(query['kwc'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not all(math.isfinite(v) for v in (lat, lon, kwc)): return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180 and round(kwc, 2) > 0): return None
+    return {'kwc': f"{kwc:.2f}", 'lat': f"{lat:.4f}", 'lon': f"{lon:.4f}"}
+
+def _hourly_production_etag(params):
+    return quote_etag(hashlib.sha256(f"{HOURLY_DATA_VERSION}|{urlencode(params)}".encode()).hexdigest())
+
+def _history_etag(request):
+    state = SimulationResult.objects.filter(user=request.user).aggregate(latest=Max('created_at'), count=Count('id'))
+    latest = state['latest'].isoformat() if state['latest'] else ''
+    return hashlib.sha256(f"{HISTORY_DATA_VERSION}|{request.user.pk}|{latest}|{state['count']}".encode()).hexdigest()
+
 @login_required
 @csrf_exempt
 def hourly_production_api(request):
     if request.method == 'POST':
-        FALLBACK_CURVE = [ 0.00, 0.00, 0.00, 0.00, 0.00, 0.00, 0.05, 0.20, 0.50, 0.80, 0.95, 1.00, 1.00, 0.95, 0.80, 0.50, 0.20, 0.05, 0.00, 0.00, 0.00, 0.00, 0.00, 0.00 ]
-        
         try:
             data = json.loads(request.body)
-            lat, lon, peak_power_kwc = data.get('lat'), data.get('lon'), data.get('kwc')
+        except ValueError:
+            return JsonResponse({'error': 'Données invalides'}, status=400)
+        lat, lon, peak_power_kwc = data.get('lat'), data.get('lon'), data.get('kwc')
 
-            if not all([lat, lon, peak_power_kwc]):
-                return JsonResponse({'error': 'Données manquantes'}, status=400)
+        if not all([lat, lon, peak_power_kwc]):
+            return JsonResponse({'error': 'Données manquantes'}, status=400)
 
-            api_url = f"{PVGIS_API_BASE_URL}seriescalc?lat={lat}&lon={lon}&pvcalculation=1&loss=14&outputformat=json"
-            
-            response = requests.get(api_url, timeout=5)
-            response.raise_for_status()
-            pvgis_data = response.json()
-            
-            if 'hourly' not in pvgis_data.get('outputs', {}): raise ValueError("La réponse de l'API PVGIS ne contient pas de données horaires.")
+        production, _ = compute_hourly_production(lat, lon, peak_power_kwc)
+        return JsonResponse(production, safe=False)
 
-            hourly_data = pvgis_data['outputs']['hourly']
-            avg_hourly_production_w_per_kwc = [0] * 24
-            num_days = len(hourly_data) / 24
-            if num_days < 1: raise ValueError("Données horaires insuffisantes.")
+    return JsonResponse({'error': 'Méthode non autorisée'}, status=405)
+
+@login_required
+def hourly_production_curve_api(request):
+    if request.method in ('GET', 'HEAD'):
+        params = canonical_hourly_params(request.GET)
+        if params is None:
+            return JsonResponse({'error': 'Paramètres lat, lon et kwc invalides ou manquants'}, status=400)
+
+        # Une seule URL par courbe pour que le cache du navigateur retrouve toujours la même entrée.
+        canonical_query = urlencode(params)
+        if request.GET.urlencode() != canonical_query:
+            return HttpResponsePermanentRedirect(f"{request.path}?{canonical_query}")
+
+        # L'ETag ne décrit que la courbe PVGIS : il n'est posé que sur cette représentation,
+        # d'où la vérification ici plutôt qu'avec @condition, qui l'ajouterait aussi à la courbe de secours.
+        etag = _hourly_production_etag(params)
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            not_modified['ETag'] = etag
+            patch_cache_control(not_modified, private=True, max_age=HOURLY_CACHE_MAX_AGE)
+            return not_modified
+
+        production, pvgis_online = compute_hourly_production(float(params['lat']), float(params['lon']), float(params['kwc']))
+        response = JsonResponse(production, safe=False)
+        if pvgis_online:
+            response['ETag'] = etag
+            patch_cache_control(response, private=True, max_age=HOURLY_CACHE_MAX_AGE)
+        else:
+            # La courbe de secours ne doit pas rester en cache une fois PVGIS de nouveau joignable.
+            add_never_cache_headers(response)
+        return response
 
-            for record in hourly_data:
-                hour_of_day = int(record['time'][9:11])
-                avg_hourly_production_w_per_kwc[hour_of_day] += record['P']
-            
-            avg_hourly_production_kw = [
-                round(((s / num_days) / 1000) * peak_power_kwc, 2) 
-                for s in avg_hourly_production_w_per_kwc
-            ]
-            return JsonResponse(avg_hourly_production_kw, safe=False)
-
-        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
-            print(f"AVERTISSEMENT API PVGIS (horaire): {e}. Utilisation de la courbe de secours.")
-            fallback_production = [round(val * peak_power_kwc, 2) for val in FALLBACK_CURVE]
-            return JsonResponse(fallback_production, safe=False)
-            
     return JsonResponse({'error': 'Méthode non autorisée'}, status=405)
 
 @login_required 
 @csrf_exempt
+@condition(etag_func=_history_etag)
 def history_api(request):
     if request.method == 'GET':
         simulations = SimulationResult.objects.filter(user=request.user)[:20]
@@ -195,7 +439,10 @@ def history_api(request):
                 'id': sim.id,
                 'simulation_data': sim_data
             })
-        return JsonResponse(data, safe=False)
+        response = JsonResponse(data, safe=False)
+        # Toujours revalider : une nouvelle simulation change l'ETag, sinon le serveur répond 304.
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
     return JsonResponse({'error': 'Méthode non autorisée'}, status=405)
 
 @login_required